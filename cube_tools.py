@@ -7,6 +7,10 @@ import pandas as pd
 import numpy as np
 import rasterio
 from rasterio.windows import Window
+from rasterio.enums import Resampling
+from contextlib import ExitStack
+import warnings
+import ast
 import csv
 import datetime as dt
 import logging
@@ -19,6 +23,17 @@ stream_handler = logging.StreamHandler()
 # Don't forget to add the handler.
 logger.addHandler(stream_handler)
 
+# Common spectral indices, over Sentinel-2 band names.
+INDICES = {
+    'NDVI': '(B08 - B04) / (B08 + B04)',
+    'NDWI': '(B03 - B08) / (B03 + B08)',
+    'NBR': '(B08 - B12) / (B08 + B12)',
+}
+
+# Arithmetic operators allowed in index expressions.
+_BINOPS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+           ast.Div: np.divide, ast.Pow: np.power}
+
 
 def _get_pattern(oneFullpath):
     """ Sources the date extracted from Sentinel-2 fullpath filenames.
@@ -32,6 +47,20 @@ def _get_pattern(oneFullpath):
 
 
 
+def _block_windows(height, width, blockSize):
+    """ Yields windows tiling an image of given dimensions, row wise.
+    Args:
+        height, width (int): Image dimensions.
+        blockSize (int): Side of each square block. Edge blocks are clipped to the image.
+    Returns:
+        generator of rasterio Window objects
+    """
+    for row in range(0, height, blockSize):
+        for col in range(0, width, blockSize):
+            yield Window(col, row, min(blockSize, width-col), min(blockSize, height-row))
+
+
+
 def cbdf2cbarr(cbdf, metadata):
     """ Convert dataframe of cube to corresponding 3d cube array.
     Args:
@@ -300,4 +329,301 @@ def extremeDOY(cbdf, dates, mode='max'):
         res.replace(value, dt.datetime.strptime(dates[int(value)], '%Y-%m-%d'), inplace=True)
 
     # Convert datetime objects to day of year
-    return res.dt.dayofyear
\ No newline at end of file
+    return res.dt.dayofyear
+
+
+
+def _read_mask(src, win, height, width):
+    """ Reads a window of a one-band mask, aligned to the grid of the bands.
+    Masks of coarser resolution (e.g. SCL at 20m for 10m bands) are upsampled by nearest neighbour.
+    Args:
+        src (DatasetReader): Opened mask.
+        win (Window): Window in band pixel coordinates.
+        height, width (int): Band dimensions.
+    Returns:
+        2d array with the same shape as the window.
+    """
+    if src.height == height and src.width == width:
+        return src.read(1, window=win)
+
+    ratio_y = src.height / height
+    ratio_x = src.width / width
+    mask_win = Window(win.col_off*ratio_x, win.row_off*ratio_y, win.width*ratio_x, win.height*ratio_y)
+    return src.read(1, window=mask_win, out_shape=(int(win.height), int(win.width)),
+                    resampling=Resampling.nearest)
+
+
+
+
+def compositeCube(bandPaths, maskPaths, searchPath, newFilename, method='median',
+                  maskValues=(0, 1, 3, 8, 9, 10, 11), ndviBands=('B04', 'B08'), dtype=None,
+                  nodata=0, sort=False, blockSize=256, **kwargs):
+    """ Cloud-masked composite of a timeseries, streamed block by block without loading it in memory.
+    Every date's mask (e.g. Sentinel-2 SCL) excludes pixels whose class is in maskValues,
+    then the valid observations are reduced to one value per band & pixel.
+
+    Args:
+        bandPaths (dictionary): Band name as key, list of fullpaths (one per date) as value,
+                            e.g. as returned from find().
+        maskPaths (list of strings): Fullpaths of masks, one per date, in the same order as bands.
+        searchPath (string): Where the result will be saved. Fullpath, ending to dir.
+        newFilename (string): Not a full path. Only the filename, without format ending.
+        method (string, optional): 'median' of valid observations, 'maxndvi' keeps the date of
+                            max NDVI or 'latest' keeps the latest valid observation.
+        maskValues (list of integers, optional): Mask classes to reject. By default SCL no data,
+                            saturated, cloud shadows, clouds, cirrus & snow.
+        ndviBands (tuple of strings, optional): Keys of red & nir bands, used by 'maxndvi'.
+        dtype (string, optional): Destination datatype. By default the datatype of bands.
+        nodata (float, optional): Value of pixels without any valid observation.
+        sort (boolean, optional): If True, sorts bands & masks by date, extracted from paths.
+                            Needed by 'latest', if paths are not already in ascending order.
+        blockSize (int, optional): Side of processed blocks & of output tiles. Multiple of 16.
+    Return:
+        metadata (dictionary): Metadata of written composite.
+    """
+
+    names = list(bandPaths.keys())
+    maskPaths = list(maskPaths)
+
+    # Correctly sorted fullpaths, by date.
+    if sort == True:
+        bandPaths = {name: sorted(bandPaths[name], key=_get_pattern) for name in names}
+        maskPaths = sorted(maskPaths, key=_get_pattern)
+
+    # Every band needs one mask per date.
+    assert all(len(bandPaths[name]) == len(maskPaths) for name in names)
+    if method not in ('median', 'maxndvi', 'latest'):
+        raise ValueError("method = 'median' OR 'maxndvi' OR 'latest'")
+    if method == 'maxndvi':
+        assert ndviBands[0] in names and ndviBands[1] in names
+
+    # Open a random image from bands to keep metadata.
+    with rasterio.open(bandPaths[names[0]][0]) as src:
+        metadata = src.meta
+    if dtype is None:
+        dtype = metadata['dtype']
+    height, width = metadata['height'], metadata['width']
+    metadata.update({'dtype': dtype, 'count': len(names), 'driver': 'GTiff', 'nodata': nodata,
+                     'tiled': True, 'blockxsize': blockSize, 'blockysize': blockSize})
+
+    # New filename.
+    cubeName = os.path.join(searchPath, str(newFilename) + '.tif')
+    with ExitStack() as stack:
+        srcs = {name: [stack.enter_context(rasterio.open(path)) for path in bandPaths[name]]
+                for name in names}
+        masks = [stack.enter_context(rasterio.open(path)) for path in maskPaths]
+        dst = stack.enter_context(rasterio.open(cubeName, 'w', **metadata))
+
+        for win in _block_windows(height, width, blockSize):
+            shape = (int(win.height), int(win.width))
+            # Valid pixels of every date, for this block only.
+            valid = np.empty((len(masks),) + shape, dtype=bool)
+            for t, msrc in enumerate(masks):
+                valid[t] = ~np.isin(_read_mask(msrc, win, height, width), maskValues)
+
+            out = np.full((len(names),) + shape, nodata, dtype=dtype)
+            if method == 'median':
+                # One band at a time, so only a single block's time stack is kept in memory.
+                for b, name in enumerate(names):
+                    temp = np.full((len(masks),) + shape, np.nan, dtype=np.float32)
+                    for t, src in enumerate(srcs[name]):
+                        arr = src.read(1, window=win)
+                        temp[t][valid[t]] = arr[valid[t]]
+                    with warnings.catch_warnings():
+                        # All-NaN pixels have no valid observation.
+                        warnings.simplefilter('ignore', category=RuntimeWarning)
+                        med = np.nanmedian(temp, axis=0)
+                    found = ~np.isnan(med)
+                    out[b][found] = med[found]
+
+            elif method == 'maxndvi':
+                best = np.full(shape, -np.inf, dtype=np.float32)
+                for t in range(len(masks)):
+                    if not valid[t].any():
+                        continue
+                    arrs = [srcs[name][t].read(1, window=win) for name in names]
+                    red = arrs[names.index(ndviBands[0])].astype(np.float32)
+                    nir = arrs[names.index(ndviBands[1])].astype(np.float32)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        ndvi = (nir - red) / (nir + red)
+                    better = valid[t] & (ndvi > best)
+                    best[better] = ndvi[better]
+                    for b, arr in enumerate(arrs):
+                        out[b][better] = arr[better]
+
+            else:
+                # Walk backwards in time, keeping the first valid observation found.
+                filled = np.zeros(shape, dtype=bool)
+                for t in reversed(range(len(masks))):
+                    take = valid[t] & ~filled
+                    if not take.any():
+                        continue
+                    for b, name in enumerate(names):
+                        arr = srcs[name][t].read(1, window=win)
+                        out[b][take] = arr[take]
+                    filled |= take
+                    if filled.all():
+                        break
+
+            dst.write(out, window=win)
+
+        for id, name in enumerate(names, start=1):
+            dst.set_band_description(id, name)
+
+    logger.info("Metadata of written composite are:\n{}".format(metadata))
+    return metadata
+
+
+
+
+def _check_expression(node, names):
+    """ Validates an index expression, allowing only arithmetic over known band names.
+    Args:
+        node (ast node): Parsed expression.
+        names (list of strings): Band names available to the expression.
+    Returns:
+        None
+    """
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name):
+            if child.id not in names:
+                raise ValueError("Band '{}' of expression not given in bands.".format(child.id))
+        elif isinstance(child, ast.Constant):
+            if not isinstance(child.value, (int, float)):
+                raise ValueError("Only numeric constants allowed in expression.")
+        elif isinstance(child, ast.BinOp):
+            if type(child.op) not in _BINOPS:
+                raise ValueError("Only + - * / ** allowed in expression.")
+        elif isinstance(child, ast.UnaryOp):
+            if not isinstance(child.op, (ast.USub, ast.UAdd)):
+                raise ValueError("Only + - * / ** allowed in expression.")
+        elif not isinstance(child, (ast.Expression, ast.Load, ast.operator, ast.unaryop)):
+            raise ValueError("Unsupported syntax in expression: {}".format(type(child).__name__))
+
+
+
+
+def _evaluate(node, arrays):
+    """ Evaluates a parsed index expression in float32, reusing intermediate results in place.
+    Input band arrays are never overwritten, so a band may appear more than once.
+    Args:
+        node (ast node): Parsed & checked expression.
+        arrays (dictionary): Band name as key, 2d float32 array as value.
+    Returns:
+        result (array or float32), owned (boolean): owned is True if result is a temporary
+                    which may be overwritten.
+    """
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body, arrays)
+    if isinstance(node, ast.Name):
+        return arrays[node.id], False
+    if isinstance(node, ast.Constant):
+        return np.float32(node.value), False
+    if isinstance(node, ast.UnaryOp):
+        value, owned = _evaluate(node.operand, arrays)
+        if isinstance(node.op, ast.UAdd):
+            return value, owned
+        if owned:
+            return np.negative(value, out=value), True
+        value = np.negative(value)
+        return value, isinstance(value, np.ndarray)
+
+    left, left_owned = _evaluate(node.left, arrays)
+    right, right_owned = _evaluate(node.right, arrays)
+    func = _BINOPS[type(node.op)]
+    # Write the result over a temporary operand, if any, instead of allocating a new one.
+    if left_owned:
+        return func(left, right, out=left), True
+    if right_owned:
+        return func(left, right, out=right), True
+    value = func(left, right)
+    return value, isinstance(value, np.ndarray)
+
+
+
+
+def indexCube(expression, bands, searchPath, newFilename, sort=False, blockSize=256, **kwargs):
+    """ Compute a spectral index timeseries cube from band math, block by block, in float32.
+    Bands are read directly from per-date images or from existing cubes, so no full size
+    temporaries or dataframes are created.
+
+    Args:
+        expression (string): Arithmetic over band names, e.g. '(B08 - B04) / (B08 + B04)',
+                            or a key of INDICES, e.g. 'NDVI'.
+        bands (dictionary): Band name as key. Value is either a list of fullpaths (one per date),
+                            e.g. as returned from find(), or the fullpath of a cube with one
+                            layer per date, e.g. as written from writeCube().
+        searchPath (string): Where the result will be saved. Fullpath, ending to dir.
+        newFilename (string): Not a full path. Only the filename, without format ending.
+        sort (boolean, optional): If True, sorts lists of fullpaths by date, extracted from paths.
+                            Also, dates are written at .txt file, with the same output name, as cube.
+        blockSize (int, optional): Side of processed blocks & of output tiles. Multiple of 16.
+    Return:
+        datetimes (list of dates): Dates in stacked order.
+        metadata (dictionary): Metadata of written cube.
+    """
+
+    expression = INDICES.get(expression, expression)
+    tree = ast.parse(expression, mode='eval')
+    # Keep only bands used by the expression.
+    names = sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name)})
+    _check_expression(tree, list(bands.keys()))
+
+    datetimes = None
+    sources = {}
+    for name in names:
+        if isinstance(bands[name], str):
+            sources[name] = bands[name]
+        else:
+            # Correctly sorted fullpaths, by date.
+            sources[name] = sorted(bands[name], key=_get_pattern) if sort else list(bands[name])
+            if sort and datetimes is None:
+                datetimes = [_get_pattern(path).date() for path in sources[name]]
+
+    with ExitStack() as stack:
+        # Every band as list of (dataset, layer) pairs, one per date.
+        layers = {}
+        for name in names:
+            if isinstance(sources[name], str):
+                src = stack.enter_context(rasterio.open(sources[name]))
+                layers[name] = [(src, id) for id in range(1, src.count+1)]
+            else:
+                layers[name] = [(stack.enter_context(rasterio.open(path)), 1) for path in sources[name]]
+
+        # Every band needs the same number of dates.
+        count = len(layers[names[0]])
+        assert all(len(layers[name]) == count for name in names)
+
+        src = layers[names[0]][0][0]
+        metadata = src.meta
+        metadata.update({'dtype': 'float32', 'count': count, 'driver': 'GTiff', 'nodata': np.nan,
+                         'tiled': True, 'blockxsize': blockSize, 'blockysize': blockSize})
+
+        if datetimes is not None:
+            # Export datetimes to file.
+            with open(os.path.join(searchPath, str(newFilename) + '.txt'), 'w') as myfile:
+                myfile.write('\n'.join([item.strftime('%Y-%m-%d') for item in datetimes]))
+
+        # New filename.
+        cubeName = os.path.join(searchPath, str(newFilename) + '.tif')
+        dst = stack.enter_context(rasterio.open(cubeName, 'w', **metadata))
+
+        for win in _block_windows(metadata['height'], metadata['width'], blockSize):
+            for t in range(count):
+                arrays = {name: layers[name][t][0].read(layers[name][t][1], window=win).astype(
+                    np.float32, copy=False) for name in names}
+                with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                    res, owned = _evaluate(tree, arrays)
+                if not owned:
+                    # Expression is a single band or a constant.
+                    res = np.full((int(win.height), int(win.width)), res, dtype=np.float32)
+                # Division by zero is no data.
+                res[~np.isfinite(res)] = np.nan
+                dst.write(res, t+1, window=win)
+
+        if datetimes is not None:
+            for id, date in enumerate(datetimes, start=1):
+                dst.set_band_description(id, date.strftime('%Y-%m-%d'))
+
+    logger.info("Metadata of written cube are:\n{}".format(metadata))
+    return datetimes, metadata